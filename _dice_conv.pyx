@@ -0,0 +1,32 @@
+# cython: boundscheck=False, wraparound=False
+"""
+File: _dice_conv.pyx
+
+A compiled version of the integer convolution used by dice.py, 
+for when Numba isn't available.  Build it in place with
+
+    cythonize -i _dice_conv.pyx
+
+and dice.py will pick it up automatically.
+"""
+
+from libc.stdint cimport int64_t
+
+def conv_i64(const int64_t[::1] a, const int64_t[::1] b, int64_t[::1] out):
+    """
+    Writes the convolution of the int64 arrays a and b into out, 
+    which must have length len(a)+len(b)-1.
+    """
+    cdef Py_ssize_t na = a.shape[0], nb = b.shape[0]
+    cdef Py_ssize_t i, k, lo, hi
+    cdef int64_t total
+    if out.shape[0] != na + nb - 1:
+        raise ValueError("Output array has the wrong length!")
+    with nogil:
+        for k in range(na + nb - 1):
+            lo = k - nb + 1 if k >= nb else 0
+            hi = k if k < na else na - 1
+            total = 0
+            for i in range(lo, hi + 1):
+                total += a[i] * b[k - i]
+            out[k] = total
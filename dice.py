@@ -9,72 +9,421 @@ distribution for a given collection of dice.
 Last updated 25 January 2024.  RAM
 """
 
-import matplotlib.pyplot as plt
+import numpy as np
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from fractions import Fraction
-import random
-random.seed()
+import functools
+import heapq
+import math
+import operator
+import os
+
+__all__ = ['diceDict', 'diceProb', 'roll', 'roll_many', 'diceBarPlot']
+
+#  The FFT is only used for merges of at least this many multiply-adds
+#  (len(c1)*len(c2)), where the shorter array has at least 
+#  _FFT_MIN_LENGTH entries.  Otherwise the direct convolution is 
+#  faster, because of the FFT's overhead; measured, the FFT only wins
+#  from about 500x500, or 100x5000 for lopsided merges.
+_FFT_THRESHOLD = 200000
+_FFT_MIN_LENGTH = 64
+#  The FFT works in float64, which has a 53 bit mantissa.  If a 
+#  coefficient of the product could be larger than this bound then 
+#  rounding the result could give the wrong count, so we use the 
+#  direct (exact) convolution instead.
+_FFT_MAX_COEFF = 2**50
+#  scipy.signal is slow to import, so fftconvolve is only looked up 
+#  the first time it's needed (see "_getFftconvolve").  False means 
+#  "not looked up yet", None means SciPy isn't available.
+_fftconvolve = False
+#  For merges of at most this many multiply-adds, a compiled loop 
+#  beats np.convolve, which has more overhead per call; above it, 
+#  np.convolve is faster.  Like fftconvolve, the kernel is only 
+#  loaded the first time it's needed (see "_getConvKernel"), since
+#  Numba is slow to import.
+_KERNEL_MAX_WORK = 1000
+_conv_int64 = False
+#  Counts are kept as int64 as long as they are sure to fit, with 
+#  some room to spare.  Otherwise Python ints (object arrays) are used.
+_INT64_MAX_BITS = 60
+#  With more kinds of dice than this, the merging is split over 
+#  several threads.
+_THREAD_THRESHOLD = 32
+#  The arrays cover every value from the smallest possible total to 
+#  the largest, which is wasteful for dice like [1, 10**7] that have 
+#  a few sides spread far apart.  If the arrays would be more than 
+#  _SPARSE_RATIO times longer than the number of possible outcomes, 
+#  or longer than _MAX_DENSE_LENGTH, dictionaries are merged instead.
+_SPARSE_RATIO = 16
+_MAX_DENSE_LENGTH = 2**24
+
+#  Coefficient arrays for standard dice, keyed by the number of sides.
+#  These are shared, so they are marked as read-only.
+_LEAF_CACHE = {}
+
+#  The generator used by "roll" and "roll_many" when none is given.
+_default_rng = np.random.default_rng()
+
+def _convInt64(a, b, out):
+    """
+    Writes the convolution of the int64 arrays a and b into out, 
+    which must have length len(a)+len(b)-1.  This is compiled by 
+    Numba in "_getConvKernel", serially since it's only used for 
+    small merges, and releasing the GIL so that "_diceArray" can run
+    several merges at once on its own threads.
+    """
+    for k in range(len(out)):
+        lo = max(0, k - len(b) + 1)
+        hi = min(k, len(a) - 1)
+        total = 0
+        for i in range(lo, hi + 1):
+            total += a[i] * b[k - i]
+        out[k] = total
+
+def _getConvKernel():
+    """
+    Returns the compiled integer convolution kernel: conv_i64 from 
+    the _dice_conv module if it has been built (see _dice_conv.pyx), 
+    or else "_convInt64" compiled by Numba if that's installed.  
+    Otherwise returns None.
+    """
+    global _conv_int64
+    if _conv_int64 is False:
+        try:
+            from _dice_conv import conv_i64 as kernel
+        except ImportError:
+            try:
+                from numba import njit, types
+            except ImportError:
+                kernel = None
+            else:
+                #  The arrays in _LEAF_CACHE are read-only, so declare
+                #  a and b as read-only: writable arrays convert to 
+                #  that too, so a single compiled version serves every
+                #  merge, rather than one per mix of array flags.
+                readonly = types.Array(types.int64, 1, 'C', readonly=True)
+                signature = types.void(readonly, readonly, types.int64[::1])
+                kernel = njit(signature, cache=True, nogil=True)(_convInt64)
+        _conv_int64 = kernel
+    return _conv_int64
+
+def _getFftconvolve():
+    """
+    Returns scipy.signal.fftconvolve, or None if SciPy isn't 
+    installed.
+    """
+    global _fftconvolve
+    if _fftconvolve is False:
+        try:
+            from scipy.signal import fftconvolve
+        except ImportError:
+            fftconvolve = None
+        _fftconvolve = fftconvolve
+    return _fftconvolve
 
 def _mergeDiceDicts(d1, d2):
     """  
     A helper method, generally to be used with the "diceDict"
     method defined elsewhere.
+
+    Each argument is a pair (offset, coeffs), where coeffs is an
+    array of counts such that coeffs[i] is the number of ways of 
+    making the value offset+i.  Merging two such pairs is exactly
+    a multiplication of their generating polynomials.
     """
-    assert isinstance(d1, dict) and isinstance(d2, dict), "Invalid argument to mergeDiceDicts!"
-    if len(d1) == 0:
+    off1, c1 = d1
+    off2, c2 = d2
+    if len(c1) == 0:
         return d2
-    if len(d2) == 0:
+    if len(c2) == 0:
         return d1
+    #  No count can be more than the total number of outcomes.  If 
+    #  that could be too big for int64, use Python ints (object 
+    #  arrays) instead, so that the counts can't overflow.
+    if (c1.dtype == object or c2.dtype == object or
+            int(c1.sum()) * int(c2.sum()) >= 2**63):
+        return (off1 + off2, np.convolve(c1.astype(object), c2.astype(object)))
+    if (len(c1) * len(c2) >= _FFT_THRESHOLD and
+            min(len(c1), len(c2)) >= _FFT_MIN_LENGTH and
+            int(c1.max()) * int(c2.max()) * min(len(c1), len(c2)) <= _FFT_MAX_COEFF):
+        fftconvolve = _getFftconvolve()
+        if fftconvolve is not None:
+            product = fftconvolve(c1.astype(np.float64), c2.astype(np.float64))
+            return (off1 + off2, np.rint(product).astype(np.int64))
+    if len(c1) * len(c2) <= _KERNEL_MAX_WORK:
+        kernel = _getConvKernel()
+        if kernel is not None:
+            #  The kernel writes every entry, so there's no need to 
+            #  zero it.
+            out = np.empty(len(c1) + len(c2) - 1, dtype=np.int64)
+            kernel(c1, c2, out)
+            return (off1 + off2, out)
+    return (off1 + off2, np.convolve(c1, c2))
+
+def _toDict(d):
+    """
+    A helper method to convert a pair (offset, coeffs) back into a 
+    dictionary of outcomes, omitting the values that can't be made.
+    Since the indices are ascending, the dictionary is sorted.
+    """
+    off, coeffs = d
+    idx = np.flatnonzero(coeffs)
+    return dict(zip(_outcomeValues(off, idx), coeffs[idx].tolist()))
+
+def _outcomeValues(off, idx):
+    """
+    Returns the list of values offset+i for the indices i in idx.
+    The offset is a Python int, which might be too big for int64.
+    """
+    if -2**62 < off < 2**62:
+        return (idx + off).tolist()
+    return [ i + off for i in idx.tolist() ]
+
+def _diceListArg(diceList, name):
+    """
+    Checks the diceList argument of the method called name, 
+    recasts a single number into a list with one element, and 
+    cleans the dice with "_cleanDice".
+    """
+    if not isinstance(diceList, list):
+        try:
+            diceList = [ operator.index(diceList) ]
+        except TypeError:
+            raise TypeError("Invalid argument to %s!" % name) from None
+    return _cleanDice(diceList)
+
+def _pickDtype(diceList):
+    """
+    Returns the dtype to use for the counts of the dice in diceList.
+    No count can be more than the total number of outcomes, which is
+    the product of the numbers of sides, so int64 is used if that's
+    at most 2**_INT64_MAX_BITS, and Python ints otherwise.  The dice
+    should already have been cleaned by "_cleanDice".
+    """
+    bits = sum(math.log2(len(die) if isinstance(die, list) else die)
+               for die in diceList)
+    if bits <= _INT64_MAX_BITS:
+        return np.dtype(np.int64)
+    return np.dtype(object)
+
+def _cleanDie(die):
+    """
+    Checks that die is a positive number of sides, or a list of 
+    integers giving the numbers on the sides, and returns it with 
+    every number as a plain int.  Anything that can be used as an 
+    index (numpy integers, and bools, which count as 0 and 1) is 
+    accepted as an integer.
+    """
+    if isinstance(die, list):
+        try:
+            return [ operator.index(x) for x in die ]
+        except TypeError:
+            raise TypeError("Numbers on the sides of a die must be integers!") from None
+    try:
+        die = operator.index(die)
+    except TypeError:
+        raise TypeError("Invalid die supplied!") from None
+    if die <= 0:
+        raise ValueError("Negative number supplied as number of sides of die!")
+    return die
+
+def _cleanDice(diceList):
+    """
+    Returns diceList with each die passed through "_cleanDie".  A die
+    with no sides doesn't change the outcomes, so it's left out.
+    """
+    return [ _cleanDie(die) for die in diceList
+             if not (isinstance(die, list) and len(die) == 0) ]
+
+def _dieArray(die, dtype):
+    """
+    Returns the pair (offset, coeffs) for a single die, as described
+    in "_mergeDiceDicts", with counts of the given dtype.  The die
+    should already have been cleaned by "_cleanDie".
+    """
+    #  Check if the "die" element itself is a list.  If so,
+    #  interpret it as a single die where the values of the sides
+    #  are the elements of that list.  (Allows for dice with the 
+    #  same values on sides, Sicherman dice, negative numbers, etc.)
+    if isinstance(die, list):
+        #  Shift before converting, as the sides themselves might not
+        #  fit in an int64 (only their spread has to).
+        lo = min(die)
+        arr = np.asarray([ x - lo for x in die ], dtype=np.int64)
+        return (lo, np.bincount(arr).astype(dtype))
+    #  Otherwise, if it's a single integer, we assume it's positive,
+    #  and is representing a die with that many sides, numbered
+    #  with the labels { 1, ..., n } where n is that integer.
+    else:
+        coeffs = _LEAF_CACHE.get(die)
+        if coeffs is None:
+            coeffs = np.ones(die, dtype=np.int64)
+            coeffs.setflags(write=False)
+            _LEAF_CACHE[die] = coeffs
+        return (1, coeffs.astype(dtype, copy=False))
+
+def _powerDiceArray(d, k):
+    """
+    Returns the pair (offset, coeffs) for k copies of the die 
+    given by the pair d, i.e. the k-th power of its generating 
+    polynomial.  Uses exponentiation by squaring, so only 
+    O(log k) merges are needed rather than k-1.
+    """
+    result = None
+    while k:
+        if k & 1:
+            result = d if result is None else _mergeDiceDicts(result, d)
+        k >>= 1
+        if k:
+            d = _mergeDiceDicts(d, d)
+    return result
+
+def _reduceArrays(arrays):
+    """
+    Merges a list of pairs (offset, coeffs) into one.  The two 
+    shortest arrays are always merged first (as in building a 
+    Huffman code), which keeps the intermediate arrays as small as
+    possible for as long as possible.
+    """
+    #  The index i breaks ties between arrays of the same length, so
+    #  that the heap never has to compare the arrays themselves.
+    heap = [ (len(coeffs), i, off, coeffs)
+             for i, (off, coeffs) in enumerate(arrays) ]
+    heapq.heapify(heap)
+    i = len(heap)
+    while len(heap) > 1:
+        _, _, off1, c1 = heapq.heappop(heap)
+        _, _, off2, c2 = heapq.heappop(heap)
+        off, coeffs = _mergeDiceDicts((off1, c1), (off2, c2))
+        heapq.heappush(heap, (len(coeffs), i, off, coeffs))
+        i += 1
+    _, _, off, coeffs = heap[0]
+    return (off, coeffs)
+
+def _diceArray(diceList):
+    """
+    The work of "diceDict", returning a pair (offset, coeffs) as 
+    described in "_mergeDiceDicts".
+
+    Identical dice are grouped together, and each group is handled
+    by "_powerDiceArray".  The results are then merged by 
+    "_reduceArrays", split over several threads if there are many.
+    The dice should already have been cleaned by "_cleanDice".
+    """
+    if len(diceList) == 0:
+        return (0, np.zeros(0, dtype=np.int64))
+    counts = Counter()
+    dice = dict()
+    for die in diceList:
+        key = tuple(die) if isinstance(die, list) else die
+        counts[key] += 1
+        dice.setdefault(key, die)
+    dtype = _pickDtype(diceList)
+    arrays = [ _powerDiceArray(_dieArray(dice[key], dtype), k)
+               for key, k in counts.items() ]
+    ncpu = os.cpu_count() or 1
+    if len(arrays) <= _THREAD_THRESHOLD or ncpu == 1:
+        return _reduceArrays(arrays)
+    #  The convolutions release the GIL, so independent chunks can be
+    #  reduced in parallel.  Dealing out the arrays in order of length
+    #  gives each thread a similar amount of work.
+    #  There's no point in more chunks than arrays (an empty chunk
+    #  couldn't be reduced anyway).
+    nchunks = min(ncpu, len(arrays))
+    arrays.sort(key=lambda d: len(d[1]))
+    chunks = [ arrays[j::nchunks] for j in range(nchunks) ]
+    with ThreadPoolExecutor(max_workers=nchunks) as executor:
+        partial = list(executor.map(_reduceArrays, chunks))
+    return _reduceArrays(partial)
+
+def _isSparse(diceList):
+    """
+    Decides whether the dice in diceList (already cleaned by 
+    "_cleanDice") should be merged as dictionaries rather than as 
+    arrays, as described at _SPARSE_RATIO.
+    """
+    length = 1 + sum(max(die) - min(die) if isinstance(die, list) else die - 1
+                     for die in diceList)
+    if length > _MAX_DENSE_LENGTH:
+        return True
+    #  The product of the numbers of different sides bounds the number
+    #  of possible outcomes.  It grows quickly, so stop once it's big.
+    outcomes = 1
+    for die in diceList:
+        outcomes *= len(set(die)) if isinstance(die, list) else die
+        if outcomes * _SPARSE_RATIO >= length:
+            return False
+    return outcomes * _SPARSE_RATIO < length
+
+def _mergeSparseDicts(d1, d2):
+    """
+    The dictionary version of "_mergeDiceDicts", used for the dice 
+    that "_isSparse" picks out.
+    """
     newDict = dict()
-    for k1 in d1.keys():
-        for k2 in d2.keys():
+    for k1, v1 in d1.items():
+        for k2, v2 in d2.items():
             newK = k1 + k2          # new key
-            newV = d1[k1] * d2[k2]  # number of ways of making newK 
-                                    # from the two given keys
-            newDict[newK] = newDict.get(newK, 0) + newV  #  create/update 
-                                                         # the new key in 
-                                                         # the result
+            newDict[newK] = newDict.get(newK, 0) + v1 * v2
     return newDict
 
+def _sparseDiceDict(diceList):
+    """
+    The dictionary version of "_diceArray", returning the sorted 
+    dictionary of outcomes directly.
+    """
+    #  As in "_reduceArrays", the two smallest are merged first, and 
+    #  the index i breaks ties.
+    heap = []
+    for i, die in enumerate(diceList):
+        if isinstance(die, list):
+            d = dict(Counter(die))
+        else:
+            d = { x : 1 for x in range(1, die+1) }
+        heap.append((len(d), i, d))
+    if len(heap) == 0:
+        return dict()
+    heapq.heapify(heap)
+    i = len(heap)
+    while len(heap) > 1:
+        _, _, d1 = heapq.heappop(heap)
+        _, _, d2 = heapq.heappop(heap)
+        d = _mergeSparseDicts(d1, d2)
+        heapq.heappush(heap, (len(d), i, d))
+        i += 1
+    return dict(sorted(heap[0][2].items()))
+
 def diceDict(diceList):
     """
-    A "merge sort" type of procedure to generate a dictionary of 
-    outcomes of a list of dice numbers that describe the number of 
-    sides on each side.  
+    Generates a dictionary of outcomes of a list of dice numbers 
+    that describe the number of sides on each side.  A single 
+    integer is recast into a list with one element.
     
     Each element of diceList is a positive number, or another list.  
     If it's a positive number n, it's for a die with that many 
     sides with numbers {1, ..., n}.  If it's a list, it's for a 
     die where the list describes the numbers on the sides of the 
-    die (which could be positive, zero, or negative, and could 
-    have repetitions).   
+    die (which must be integers, but could be positive, zero, or 
+    negative, and could have repetitions).   
     """
-    assert isinstance(diceList, list), "Invalid argument to diceDict!"
-    if len(diceList) == 0:
-        return dict()
-    elif len(diceList) == 1:
-        #  Check if the "die" element itself is a list.  If so,
-        #  interpret it as a single die where the values of the sides
-        #  are the elements of that list.  (Allows for dice with the 
-        #  same values on sides, Sicherman dice, negative numbers, etc.)
-        if isinstance(diceList[0], list):
-            newDict = dict()
-            for x in set(diceList[0]):
-                newDict[x] = diceList[0].count(x)
-            return newDict
-        #  Otherwise, if it's a single integer, we assume it's positive,
-        #  and is representing a die with that many sides, numbered
-        #  with the labels { 1, ..., n } where n is that integer.
-        else:
-            assert diceList[0] > 0, "Negative number supplied as number of sides of die!"
-            return { x : 1 for x in range(1, diceList[0]+1) }
-    #  Otherwise, there are at least two elements in the list, so 
-    #  split and recurse.
-    random.shuffle(diceList)
-    L = int(len(diceList)/2)
-    leftDict = diceDict( diceList[:L] )
-    rightDict = diceDict( diceList[L:] )
-    final = _mergeDiceDicts(leftDict, rightDict)
-    return { k: v for k, v in sorted(final.items()) }
+    diceList = _diceListArg(diceList, "diceDict")
+    #  A list of standard dice can be used as a cache key, once it's 
+    #  put in a canonical order.  The cached dictionary is copied so 
+    #  the caller is free to change the one they get back.
+    if all(isinstance(d, int) for d in diceList):
+        return dict(_cachedDiceDict(tuple(sorted(diceList))))
+    if _isSparse(diceList):
+        return _sparseDiceDict(diceList)
+    return _toDict(_diceArray(diceList))
+
+@functools.lru_cache(maxsize=128)
+def _cachedDiceDict(key):
+    """
+    The memoized version of "diceDict" for a sorted tuple of 
+    standard dice.
+    """
+    return _toDict(_diceArray(list(key)))
 
 def diceProb(diceList, exact=True):
     """ 
@@ -88,24 +437,49 @@ def diceProb(diceList, exact=True):
     If it's a positive number n, it's for a die with that many 
     sides with numbers {1, ..., n}.  If it's a list, it's for a 
     die where the list describes the numbers on the sides of the 
-    die (which could be positive, zero, or negative, and could 
-    have repetitions).   
+    die (which must be integers, but could be positive, zero, or 
+    negative, and could have repetitions).   
     
     The parameter "exact" controls whether floating point numbers are
     returned, or if exact values are returned using the Fraction
     class from the fractions module.
     """
-    assert isinstance(diceList, (list, int)), "Invalid argument to diceProb!"
-    if isinstance(diceList, int):
-        diceList = [ diceList ]    #  recast a single number to a list
-    result = diceDict(diceList)
-    s = sum(result.values())
+    diceList = _diceListArg(diceList, "diceProb")
+    if all(isinstance(d, int) for d in diceList):
+        return dict(_cachedDiceProb(tuple(sorted(diceList)), exact))
+    return _diceProb(diceList, exact)
+
+def _diceProb(diceList, exact):
+    """
+    The work of "diceProb", once diceList has been recast to a list.
+    """
+    if _isSparse(diceList):
+        result = _sparseDiceDict(diceList)
+        s = sum(result.values())
+        if exact:
+            return { x : Fraction(v,s) for x, v in result.items() }
+        else:
+            return { x : v/s for x, v in result.items() }
+    off, coeffs = _diceArray(diceList)
+    #  Only keep the values that can actually be made.
+    idx = np.flatnonzero(coeffs)
+    counts = coeffs[idx]
+    s = int(counts.sum())
     if exact:
-        return { x : Fraction(result[x],s) for x in sorted(result.keys()) }
+        probs = [ Fraction(c,s) for c in counts.tolist() ]
     else:
-        return { x : result[x]/s for x in sorted(result.keys()) }
+        probs = (counts / s).tolist()
+    return dict(zip(_outcomeValues(off, idx), probs))
 
-def roll(diceList):
+@functools.lru_cache(maxsize=128)
+def _cachedDiceProb(key, exact):
+    """
+    The memoized version of "diceProb" for a sorted tuple of 
+    standard dice.
+    """
+    return _diceProb(list(key), exact)
+
+def roll(diceList, num_rolls=1, rng=None):
     """ 
     Returns a "roll" of the dice described in diceList.  diceList
     is either a single integer (in which case it's assumed to be
@@ -116,19 +490,46 @@ def roll(diceList):
     If it's a positive number n, it's for a die with that many 
     sides with numbers {1, ..., n}.  If it's a list, it's for a 
     die where the list describes the numbers on the sides of the 
-    die (which could be positive, zero, or negative, and could 
-    have repetitions).
+    die (which must be integers, but could be positive, zero, or 
+    negative, and could have repetitions).
+
+    If num_rolls is more than 1, the dice are rolled that many 
+    times, and a numpy array of the totals is returned instead.
+
+    rng is the numpy Generator to use, which defaults to one shared
+    by the module.  For reproducible rolls, pass in your own, 
+    e.g. np.random.default_rng(seed).  Threads rolling in parallel 
+    should each have their own generator.
     """ 
-    assert isinstance(diceList, (list, int)), "Invalid argument to roll!"
-    if isinstance(diceList, int):
-        diceList = [ diceList ]     #  recast a single number as a list
-    result = 0
+    result = roll_many(_diceListArg(diceList, "roll"), num_rolls, rng)
+    if num_rolls == 1:
+        return int(result[0])
+    return result
+
+def roll_many(diceList, trials, rng=None):
+    """
+    Rolls the dice described in diceList (as for "roll") the given
+    number of times, and returns a numpy array of the totals, of 
+    shape (trials,).  This is much faster than calling "roll" in a 
+    loop, e.g. for a Monte Carlo simulation.  rng is as for "roll".
+    """
+    diceList = _diceListArg(diceList, "roll_many")
+    #  Group identical dice together, so that each kind of die is 
+    #  rolled with a single call to the generator.
+    standard = Counter()
+    custom = Counter()
     for dice in diceList:
         if isinstance(dice, int):
-            assert dice > 0, "Negative number supplied as number of sides of die!"
-            result += random.choice(range(1, dice+1))
-        elif isinstance(dice, list):
-            result += random.choice(dice)
+            standard[dice] += 1
+        else:
+            custom[tuple(dice)] += 1
+    if rng is None:
+        rng = _default_rng
+    result = np.zeros(trials, dtype=np.int64)
+    for n, k in standard.items():
+        result += rng.integers(1, n+1, size=(trials, k)).sum(axis=1)
+    for sides, k in custom.items():
+        result += rng.choice(np.asarray(sides), size=(trials, k)).sum(axis=1)
     return result
 
 def diceBarPlot(diceList):
@@ -136,8 +537,10 @@ def diceBarPlot(diceList):
     A method to draw a histogram to illustrate the probability 
     distribution for a given set of dice described in diceList.
     """
-    assert isinstance(diceList, (list, int)), "Invalid argument to diceHist!"
-    hist = diceDict(diceList)
+    #  Imported here, since matplotlib is slow to import and only 
+    #  needed for plotting.
+    import matplotlib.pyplot as plt
+    hist = diceDict(_diceListArg(diceList, "diceBarPlot"))
     plt.bar(hist.keys(), hist.values())
 
 if __name__ == '__main__':